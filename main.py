@@ -2,12 +2,19 @@
 Bitrefill eSIM Scraper API
 FastAPI application to serve scraped eSIM data.
 """
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import List, Optional
+from collections import defaultdict
+from email.utils import formatdate
+from functools import lru_cache
 import asyncio
-from scraper import BitrefillESimScraper
+import hashlib
+import orjson
+from scraper import BitrefillESimScraper, close_shared_browser
 import logging
 
 # Configure logging
@@ -17,7 +24,8 @@ logger = logging.getLogger(__name__)
 app = FastAPI(
     title="Bitrefill eSIM Scraper API",
     description="API to extract eSIM card information from Bitrefill",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware
@@ -29,9 +37,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress larger JSON payloads for clients that accept gzip
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # Global scraper instance
 scraper = None
-cached_data = None
+cached_response = None
+cached_body = None
+cached_etag = None
+cached_last_modified = None
+country_index = {}
+cache_version = 0
 cache_lock = asyncio.Lock()
 
 
@@ -71,32 +87,133 @@ async def shutdown_event():
     global scraper
     if scraper:
         await scraper.close_browser()
+    await close_shared_browser()
     logger.info("Scraper closed")
 
 
-async def get_esim_data(force_refresh: bool = False) -> List[dict]:
-    """Get eSIM data, using cache if available."""
-    global cached_data, cache_lock
+def build_response(data: List[dict]) -> ESimResponse:
+    """Convert scraped eSIM dicts into the response model."""
+    products = []
+    for item in data:
+        plans = [
+            Plan(
+                name=plan.get('name', 'Unknown'),
+                data=plan.get('data'),
+                validity=plan.get('validity'),
+                price=plan.get('price')
+            )
+            for plan in item.get('plans', [])
+        ]
+        
+        products.append(ESimProduct(
+            country=item.get('country', 'Unknown'),
+            countries_covered=item.get('countries_covered', []),
+            plans=plans
+        ))
+    
+    return ESimResponse(
+        products=products,
+        total_count=len(products)
+    )
+
+
+def cache_response(response: ESimResponse):
+    """Cache the response model together with its serialized JSON body."""
+    global cached_response, cached_body, cached_etag, cached_last_modified, country_index, cache_version
+    
+    # Map each lowercased country name to the positions of matching products
+    index = defaultdict(list)
+    for position, product in enumerate(response.products):
+        names = {product.country.lower()}
+        names.update(c.lower() for c in product.countries_covered)
+        for name in names:
+            index[name].append(position)
+    
+    cached_response = response
+    cached_body = orjson.dumps(response.model_dump(mode="json"))
+    # Weak, since GZipMiddleware sends the same tag with the compressed bytes
+    etag = f'W/"{hashlib.blake2b(cached_body, digest_size=16).hexdigest()}"'
+    if etag != cached_etag or cached_last_modified is None:
+        cached_last_modified = formatdate(usegmt=True)
+    cached_etag = etag
+    country_index = dict(index)
+    cache_version += 1
+
+
+def find_products_by_country(country: str) -> List[ESimProduct]:
+    """
+    Find cached products whose name or covered countries contain the query.
+    
+    Matching is a case-insensitive substring test against the distinct country
+    names in the index, so each name is checked once per query.
+    """
+    query = country.lower()
+    positions = set()
+    for name, name_positions in country_index.items():
+        if query in name:
+            positions.update(name_positions)
+    return [cached_response.products[position] for position in sorted(positions)]
+
+
+@lru_cache(maxsize=512)
+def build_country_response(version: int, country: str) -> ESimResponse:
+    """
+    Build the response for a country query, memoized per cache version.
+    
+    Refreshing the cache bumps cache_version, so stale entries are never hit
+    and simply age out of the LRU.
+    """
+    products = find_products_by_country(country)
+    return ESimResponse(
+        products=products,
+        total_count=len(products)
+    )
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    Check whether the request's If-None-Match header matches the ETag.
+    
+    If-None-Match uses weak comparison, so W/ prefixes are ignored on both sides.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    if "*" in tags:
+        return True
+    opaque_tag = etag[2:] if etag.startswith("W/") else etag
+    return any((tag[2:] if tag.startswith("W/") else tag) == opaque_tag for tag in tags)
+
+
+async def get_esim_data(force_refresh: bool = False) -> ESimResponse:
+    """
+    Get eSIM data, using cache if available.
+    
+    The response model is built once per scrape, so cached requests skip
+    validation entirely.
+    """
+    global cached_response, cache_lock
     
-    if not force_refresh and cached_data:
-        return cached_data
+    if not force_refresh and cached_response and cached_response.products:
+        return cached_response
     
     async with cache_lock:
         # Double-check after acquiring lock
-        if not force_refresh and cached_data:
-            return cached_data
+        if not force_refresh and cached_response and cached_response.products:
+            return cached_response
         
         try:
             logger.info("Scraping eSIM data from Bitrefill...")
-            data = await scraper.scrape_esim_data()
-            cached_data = data
+            data = await scraper.scrape_esim_data(use_cache=not force_refresh)
+            cache_response(build_response(data))
             logger.info(f"Scraped {len(data)} eSIM products")
-            return data
+            return cached_response
         except Exception as e:
             logger.error(f"Error scraping data: {e}")
-            if cached_data:
+            if cached_response and cached_response.products:
                 logger.warning("Returning cached data due to error")
-                return cached_data
+                return cached_response
             raise
 
 
@@ -116,10 +233,13 @@ async def root():
 
 
 @app.get("/esims", response_model=ESimResponse, tags=["eSIMs"])
-async def get_esims(force_refresh: bool = False):
+async def get_esims(request: Request, force_refresh: bool = False):
     """
     Get all eSIM products.
     
+    The body is serialized once per scrape and served as-is; clients that send
+    a matching If-None-Match header get a 304 with no body.
+    
     Args:
         force_refresh: If True, force a fresh scrape instead of using cache.
     
@@ -127,34 +247,15 @@ async def get_esims(force_refresh: bool = False):
         List of all eSIM products with countries, plans, and prices.
     """
     try:
-        data = await get_esim_data(force_refresh=force_refresh)
-        
-        # Convert to response model
-        products = []
-        for item in data:
-            plans = [
-                Plan(
-                    name=plan.get('name', 'Unknown'),
-                    data=plan.get('data'),
-                    validity=plan.get('validity'),
-                    price=plan.get('price')
-                )
-                for plan in item.get('plans', [])
-            ]
-            
-            products.append(ESimProduct(
-                country=item.get('country', 'Unknown'),
-                countries_covered=item.get('countries_covered', []),
-                plans=plans
-            ))
-        
-        return ESimResponse(
-            products=products,
-            total_count=len(products)
-        )
+        await get_esim_data(force_refresh=force_refresh)
     except Exception as e:
         logger.error(f"Error in get_esims: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    
+    headers = {"ETag": cached_etag, "Last-Modified": cached_last_modified}
+    if etag_matches(request, cached_etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=cached_body, media_type="application/json", headers=headers)
 
 
 @app.get("/esims/{country}", response_model=ESimResponse, tags=["eSIMs"])
@@ -170,39 +271,8 @@ async def get_esims_by_country(country: str, force_refresh: bool = False):
         Filtered list of eSIM products for the specified country.
     """
     try:
-        data = await get_esim_data(force_refresh=force_refresh)
-        
-        # Filter by country (case-insensitive)
-        country_lower = country.lower()
-        filtered_data = [
-            item for item in data
-            if country_lower in item.get('country', '').lower() or
-            any(country_lower in c.lower() for c in item.get('countries_covered', []))
-        ]
-        
-        # Convert to response model
-        products = []
-        for item in filtered_data:
-            plans = [
-                Plan(
-                    name=plan.get('name', 'Unknown'),
-                    data=plan.get('data'),
-                    validity=plan.get('validity'),
-                    price=plan.get('price')
-                )
-                for plan in item.get('plans', [])
-            ]
-            
-            products.append(ESimProduct(
-                country=item.get('country', 'Unknown'),
-                countries_covered=item.get('countries_covered', []),
-                plans=plans
-            ))
-        
-        return ESimResponse(
-            products=products,
-            total_count=len(products)
-        )
+        await get_esim_data(force_refresh=force_refresh)
+        return build_country_response(cache_version, country.lower())
     except Exception as e:
         logger.error(f"Error in get_esims_by_country: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -217,10 +287,10 @@ async def refresh_cache():
         Confirmation message with the number of products scraped.
     """
     try:
-        data = await get_esim_data(force_refresh=True)
+        response = await get_esim_data(force_refresh=True)
         return {
             "message": "Cache refreshed successfully",
-            "products_count": len(data)
+            "products_count": response.total_count
         }
     except Exception as e:
         logger.error(f"Error refreshing cache: {e}")
@@ -3,33 +3,339 @@ Bitrefill eSIM Scraper
 Extracts eSIM card information including countries, plans, and prices.
 """
 import asyncio
+import hashlib
+import json
+import math
+import os
 import re
-from typing import List, Dict, Optional
-from playwright.async_api import async_playwright, Page, Browser
-from bs4 import BeautifulSoup
+import time
+from typing import Awaitable, Callable, Iterator, List, Dict, Optional, Tuple, Union
+from urllib.parse import urljoin
+import httpx
+from playwright.async_api import async_playwright, Page, Playwright, Browser, BrowserContext, Route
+from playwright.async_api import Error as PlaywrightError
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+from bs4 import BeautifulSoup, Tag
+from selectolax.parser import HTMLParser, Node
+
+
+# Maximum number of product pages scraped concurrently
+DETAIL_CONCURRENCY = 8
+
+# Number of products returned per scrape
+MAX_PRODUCTS = 30
+
+# Cookies (including Cloudflare's cf_clearance) are reused for this long
+COOKIE_CACHE_TTL = 30 * 60
+
+# Scraped product pages are reused from the disk cache for this long
+DETAIL_CACHE_TTL = 6 * 60 * 60
+
+# Server-rendered listings with at least this many product links are scraped
+# over plain HTTP, without starting a browser
+MIN_HTTP_PRODUCT_LINKS = 5
+HTTP_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+    ),
+    "Accept-Language": "en-US,en;q=0.9",
+}
+
+# Requests the scraper never reads from, aborted to save bandwidth and render time
+BLOCKED_RESOURCE_TYPES = frozenset({"image", "font", "media", "stylesheet"})
+BLOCKED_URL_RE = re.compile(
+    r"google-analytics\.com|googletagmanager\.com|segment\.(?:com|io)|hotjar\.com|doubleclick\.net"
+)
+
+# Patterns used by the HTML fallback extractors, compiled once
+PLAN_TEXT_RE = re.compile(
+    r'(?P<price>\$[\d,]+(?:\.\d{2})?)'
+    r'|(?P<data>\d+(?:\.\d+)?\s*(?:GB|MB))'
+    r'|(?P<validity>\d+\s*days?)',
+    re.I
+)
+COVERAGE_TEXT_RE = re.compile(r'works in|countries|coverage', re.I)
+TITLE_CLASS_RE = re.compile(r'title|name|heading', re.I)
+# Product cards are matched with plain substring tests, which are cheaper
+# than a regex over every class attribute in the listing
+CANDIDATE_TOKENS = ('product', 'card', 'item', 'esim')
+PLAN_CLASS_RE = re.compile(r'plan|option|package|variant', re.I)
+PRICE_CLASS_RE = re.compile(r'price|cost|amount', re.I)
+# Whole class tokens only (or their hyphen/underscore parts), so that classes
+# like "metadata" or "planet-bg" don't count as plan details
+PLAN_INFO_CLASS_RE = re.compile(r'(?<![^\s_-])(?:data|plan)(?![^\s_-])', re.I)
+
+# Product pages are Next.js pages; their embedded page data lists the plans
+# under one of these keys, with the price under one of PLAN_PRICE_KEYS. Generic
+# keys like "options" or "amount" are left out, as filters and sort menus use them too.
+PLAN_LIST_KEYS = ('packages', 'plans', 'variants')
+PLAN_PRICE_KEYS = ('usd_price', 'price')
+
+
+# Chromium is started once per process and shared by every scraper instance;
+# each instance only opens its own (cheap) browser context on it
+_playwright: Optional[Playwright] = None
+_browser: Optional[Browser] = None
+_browser_lock: Optional[asyncio.Lock] = None
+
+
+async def get_shared_browser() -> Browser:
+    """Return the process-wide browser, launching it on first use."""
+    global _playwright, _browser, _browser_lock
+    # Created lazily so the lock binds to the running event loop
+    if _browser_lock is None:
+        _browser_lock = asyncio.Lock()
+    async with _browser_lock:
+        if _browser is None or not _browser.is_connected():
+            if _playwright is None:
+                _playwright = await async_playwright().start()
+            _browser = await _playwright.chromium.launch(headless=True)
+    return _browser
+
+
+async def close_shared_browser():
+    """
+    Close the process-wide browser and stop Playwright.
+    
+    Scrapers' close_browser() leaves the shared browser running, so callers
+    must await this before their event loop shuts down.
+    """
+    global _playwright, _browser, _browser_lock
+    if _browser is not None:
+        await _browser.close()
+    if _playwright is not None:
+        await _playwright.stop()
+    _playwright = _browser = _browser_lock = None
+
+
+def parse_plan_text(text: str) -> Dict[str, Optional[str]]:
+    """Find the first price, data amount and validity in a single scan of the text."""
+    found = {'price': None, 'data': None, 'validity': None}
+    for match in PLAN_TEXT_RE.finditer(text):
+        field = match.lastgroup
+        if found[field] is None:
+            found[field] = match.group(field)
+            if all(found.values()):
+                break
+    return found
+
+
+def format_price(value) -> Optional[str]:
+    """
+    Format a price from embedded page data the way prices appear on the page.
+    
+    Only numbers and numeric strings are accepted; anything else gives None.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        try:
+            value = float(value.lstrip('$').replace(',', ''))
+        except ValueError:
+            return None
+    if isinstance(value, (int, float)) and math.isfinite(value):
+        return f"${value:,.2f}"
+    return None
+
+
+def find_next_data_product(data) -> Optional[Dict]:
+    """
+    Find the product in a page's __NEXT_DATA__ JSON.
+    
+    Returns the first object, depth first, holding a list of priced plans under
+    one of PLAN_LIST_KEYS, normalized to the scraper's product dict shape. Plans
+    without a string name or a numeric price are skipped, so unexpected shapes
+    never reach the response models.
+    """
+    stack = [data]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(reversed(node))
+            continue
+        if not isinstance(node, dict):
+            continue
+        
+        for key in PLAN_LIST_KEYS:
+            items = node.get(key)
+            if not isinstance(items, list) or not items:
+                continue
+            if not all(isinstance(item, dict) and any(k in item for k in PLAN_PRICE_KEYS) for item in items):
+                continue
+            
+            plans = []
+            for item in items:
+                name = next(
+                    (item[k] for k in ('name', 'label', 'title') if isinstance(item.get(k), str) and item[k]),
+                    None
+                )
+                price = format_price(next(item[k] for k in PLAN_PRICE_KEYS if k in item))
+                if name is None or price is None:
+                    continue
+                details = parse_plan_text(name)
+                plans.append({
+                    'name': name[:100],
+                    'data': details['data'],
+                    'validity': details['validity'],
+                    'price': price
+                })
+            if not plans:
+                continue
+            
+            countries = node.get('countries')
+            if not isinstance(countries, list):
+                countries = []
+            countries = [
+                country.get('name') if isinstance(country, dict) else country
+                for country in countries
+            ]
+            name = next((node[k] for k in ('name', 'title') if isinstance(node.get(k), str) and node[k]), None)
+            return {
+                'name': name,
+                'countries': list(dict.fromkeys(c for c in countries if isinstance(c, str) and c)),
+                'plans': plans
+            }
+        
+        stack.extend(reversed(list(node.values())))
+    return None
+
+
+def select_products(products: List[Dict]) -> List[Dict]:
+    """Keep at most MAX_PRODUCTS products, preferring ones with plans, in their original order."""
+    with_plans = [i for i, product in enumerate(products) if product.get('plans')]
+    without_plans = [i for i, product in enumerate(products) if not product.get('plans')]
+    keep = set((with_plans + without_plans)[:MAX_PRODUCTS])
+    return [product for i, product in enumerate(products) if i in keep]
+
+
+def is_product_class(class_attr: Optional[str]) -> bool:
+    """Tell whether a class attribute contains any of the CANDIDATE_TOKENS."""
+    if not class_attr:
+        return False
+    class_attr = class_attr.lower()
+    return any(token in class_attr for token in CANDIDATE_TOKENS)
+
+
+def is_coverage_section(node: Node) -> bool:
+    """Tell whether a node is a dedicated "works in" section."""
+    attributes = node.attributes
+    class_attr = attributes.get('class') or ''
+    return 'works' in (attributes.get('data-testid') or '') or 'works-in' in class_attr or 'WorksIn' in class_attr
+
+
+def node_text(node: Node) -> str:
+    """Join a node's stripped text the way BeautifulSoup's get_text(strip=True) does."""
+    return node.text(separator='', strip=True)
 
 
 class BitrefillESimScraper:
     """Scraper for Bitrefill eSIM products."""
     
-    def __init__(self):
+    def __init__(self, cookie_cache_path: str = ".bitrefill_cookies.json",
+                 detail_cache_dir: str = ".esim_cache", use_selectolax: bool = True):
         self.base_url = "https://www.bitrefill.com/us/en/esims/"
+        self.cookie_cache_path = cookie_cache_path
+        self.detail_cache_dir = detail_cache_dir
+        # Parse the listing page with selectolax; set False to use BeautifulSoup
+        self.use_selectolax = use_selectolax
         self.browser: Optional[Browser] = None
+        self.context: Optional[BrowserContext] = None
+        # Set once the browserless HTTP scrape has come back empty or failed
+        self.http_scrape_failed = False
         
     async def init_browser(self):
-        """Initialize the browser."""
-        playwright = await async_playwright().start()
-        self.browser = await playwright.chromium.launch(headless=True)
+        """Open a context on the shared browser, reusing cached cookies if still fresh."""
+        self.browser = await get_shared_browser()
+        storage_state = self._load_storage_state()
+        try:
+            self.context = await self._new_context(storage_state=storage_state)
+        except PlaywrightError as e:
+            if storage_state is None:
+                raise
+            # Cookies Playwright rejects shouldn't keep the scraper from starting
+            print(f"Ignoring cached cookies from {self.cookie_cache_path}: {e}")
+            self.context = await self._new_context()
+        
+    async def _new_context(self, storage_state=None) -> BrowserContext:
+        """Create a browser context that skips images, fonts, styles and trackers."""
+        context = await self.browser.new_context(storage_state=storage_state)
+        await context.route("**/*", self._handle_route)
+        return context
+        
+    async def _handle_route(self, route: Route):
+        """Abort requests for resources the scraper doesn't need."""
+        request = route.request
+        if request.resource_type in BLOCKED_RESOURCE_TYPES or BLOCKED_URL_RE.search(request.url):
+            await route.abort()
+        else:
+            await route.continue_()
+        
+    def _load_storage_state(self) -> Optional[Dict]:
+        """Return the cached cookies if they exist, have not expired and parse."""
+        try:
+            if time.time() - os.path.getmtime(self.cookie_cache_path) >= COOKIE_CACHE_TTL:
+                return None
+            with open(self.cookie_cache_path, encoding='utf-8') as f:
+                storage_state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return storage_state if isinstance(storage_state, dict) else None
+        
+    async def _save_storage_state(self):
+        """Persist the browser cookies so the next run can skip the challenge."""
+        try:
+            storage_state = await self.context.storage_state()
+            # Write to a temporary file first so a crash can't leave a truncated cache
+            tmp_path = f"{self.cookie_cache_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(storage_state, f)
+            os.replace(tmp_path, self.cookie_cache_path)
+        except (PlaywrightError, OSError) as e:
+            print(f"Error saving cookies to {self.cookie_cache_path}: {e}")
+        
+    def _detail_cache_path(self, url: str) -> str:
+        """Return the disk cache file for a product page URL."""
+        key = hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
+        return os.path.join(self.detail_cache_dir, f"{key}.json")
+        
+    def _load_cached_details(self, url: str) -> Optional[Dict]:
+        """Return cached product details for a URL if they have not expired."""
+        path = self._detail_cache_path(url)
+        try:
+            if time.time() - os.path.getmtime(path) >= DETAIL_CACHE_TTL:
+                return None
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+        
+    def _save_cached_details(self, url: str, details: Dict):
+        """Write product details to the disk cache."""
+        path = self._detail_cache_path(url)
+        try:
+            os.makedirs(self.detail_cache_dir, exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(details, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error caching product details for {url}: {e}")
         
     async def close_browser(self):
-        """Close the browser."""
-        if self.browser:
-            await self.browser.close()
+        """Close this scraper's browser context; the shared browser stays up."""
+        if self.context:
+            await self.context.close()
+        self.context = None
+        self.browser = None
             
-    async def scrape_esim_data(self) -> List[Dict]:
+    async def scrape_esim_data(self, use_cache: bool = True) -> List[Dict]:
         """
         Scrape eSIM data from Bitrefill.
         
+        Args:
+            use_cache: If True, reuse product pages scraped within DETAIL_CACHE_TTL.
+        
         Returns:
             List of dictionaries containing eSIM information:
             [
@@ -49,46 +355,59 @@ class BitrefillESimScraper:
                 ...
             ]
         """
+        # Try the server-rendered HTML first; only start a browser if needed.
+        # Once that has failed, this scraper goes straight to the browser.
+        if not self.http_scrape_failed:
+            try:
+                products = await self._scrape_via_http(use_cache)
+            except Exception as e:
+                print(f"HTTP scraping failed, falling back to the browser: {e}")
+                products = []
+            if products:
+                return products
+            self.http_scrape_failed = True
+        
         if not self.browser:
             await self.init_browser()
             
-        page = await self.browser.new_page()
+        page = await self.context.new_page()
         
         try:
-            # Navigate to the eSIM page
-            await page.goto(self.base_url, wait_until="networkidle", timeout=60000)
+            # Navigate to the eSIM page. Trackers keep the network busy long after
+            # the DOM is ready, so don't wait for networkidle.
+            try:
+                await page.goto(self.base_url, wait_until="domcontentloaded", timeout=15000)
+            except PlaywrightTimeoutError:
+                pass
             
-            # Wait for content to load - try multiple selectors
-            selectors = [
-                'a[href*="/esim-"]',
-                '[data-testid*="product"]',
-                '.product-card',
-                '[class*="ProductCard"]',
-                '[class*="product"]',
-                'article',
-                'main'
-            ]
+            # Wait for product links to render (this also covers the Cloudflare
+            # challenge) instead of sleeping for a fixed time
+            try:
+                await page.wait_for_selector('a[href*="/esim-"]', timeout=10000)
+            except PlaywrightTimeoutError:
+                pass
             
-            for selector in selectors:
+            # Scroll to load lazy-loaded content, waiting only until it has arrived.
+            # Skip this when the first screen already links enough distinct products
+            # (cards often link to their product more than once).
+            product_count = await page.eval_on_selector_all(
+                'a[href*="/esim-"]', 'links => new Set(links.map(link => link.href)).size'
+            )
+            if product_count < MAX_PRODUCTS:
+                await page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
                 try:
-                    await page.wait_for_selector(selector, timeout=5000)
-                    break
-                except:
-                    continue
-            
-            # Wait for dynamic content to render
-            await asyncio.sleep(5)
-            
-            # Scroll to load lazy-loaded content
-            await page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
-            await asyncio.sleep(2)
-            await page.evaluate("window.scrollTo(0, 0)")
-            await asyncio.sleep(1)
+                    await page.wait_for_load_state("networkidle", timeout=3000)
+                except PlaywrightTimeoutError:
+                    pass
+                await page.evaluate("window.scrollTo(0, 0)")
             
             # Try to extract data using JavaScript evaluation
             products_js = await page.evaluate("""
                 () => {
                     const products = [];
+                    // Text and link count per container, computed once even when
+                    // many links share the same container
+                    const containerInfo = new Map();
                     // Look for product links
                     const links = document.querySelectorAll('a[href*="/esim-"]');
                     links.forEach(link => {
@@ -98,8 +417,17 @@ class BitrefillESimScraper:
                         // Find parent container
                         let container = link.closest('article, div[class*="card"], div[class*="product"]') || link.parentElement;
                         
+                        let info = container ? containerInfo.get(container) : null;
+                        if (container && !info) {
+                            info = {
+                                text: container.innerText,
+                                linkCount: container.querySelectorAll('a[href*="/esim-"]').length
+                            };
+                            containerInfo.set(container, info);
+                        }
+                        
                         // Extract text content
-                        const text = container ? container.innerText : link.innerText;
+                        const text = info ? info.text : link.innerText;
                         
                         // Try to find price
                         const priceMatch = text.match(/\\$[\\d,]+(?:\\.\\d{2})?/);
@@ -116,6 +444,38 @@ class BitrefillESimScraper:
                         const dataMatch = text.match(/(\\d+(?:\\.\\d+)?)\\s*(GB|MB)/i);
                         const validityMatch = text.match(/(\\d+)\\s*(days?|day)/i);
                         
+                        // Collect plans the card lists inline, so its product
+                        // page doesn't have to be opened. Only trust containers
+                        // that hold this one product, not a whole grid.
+                        const plans = [];
+                        const seenPlans = new Set();
+                        if (info && info.linkCount === 1) {
+                            container.querySelectorAll('[class*="plan"], [class*="option"], [class*="package"], [class*="variant"]').forEach(elem => {
+                                const planText = elem.innerText;
+                                // A plan and its wrapper often both match
+                                if (seenPlans.has(planText)) return;
+                                seenPlans.add(planText);
+                                const planPrice = planText.match(/\\$[\\d,]+(?:\\.\\d{2})?/);
+                                const planData = planText.match(/(\\d+(?:\\.\\d+)?)\\s*(GB|MB)/i);
+                                const planValidity = planText.match(/(\\d+)\\s*(days?|day)/i);
+                                
+                                if (planPrice || planData) {
+                                    plans.push({
+                                        name: planText.substring(0, 100).trim(),
+                                        data: planData ? planData[0] : null,
+                                        validity: planValidity ? planValidity[0] : null,
+                                        price: planPrice ? planPrice[0] : null
+                                    });
+                                }
+                            });
+                        }
+                        
+                        // Extract countries covered, if the card lists them
+                        const countryMatch = text.match(/works?\\s+in[\\s:]+([^\\n]+)/i);
+                        const countries = countryMatch ?
+                            [...new Set(countryMatch[1].split(/[,&]/).map(c => c.trim()).filter(c => c))] :
+                            [];
+                        
                         if (name && name.length > 0) {
                             products.push({
                                 name: name,
@@ -123,7 +483,8 @@ class BitrefillESimScraper:
                                 price: price,
                                 data: dataMatch ? dataMatch[0] : null,
                                 validity: validityMatch ? validityMatch[0] : null,
-                                text: text.substring(0, 200)
+                                plans: plans,
+                                countries: countries
                             });
                         }
                     });
@@ -133,15 +494,14 @@ class BitrefillESimScraper:
             
             # If we got products from JS, process them
             if products_js and len(products_js) > 0:
-                detailed_products = []
-                seen_urls = set()
+                # Deduplicate by URL before limiting, keeping the first card seen
+                unique_products = {}
+                for product in products_js:
+                    if product.get('url'):
+                        unique_products.setdefault(product['url'], product)
                 
-                for product in products_js[:30]:  # Limit to first 30
-                    url = product.get('url', '')
-                    if url in seen_urls:
-                        continue
-                    seen_urls.add(url)
-                    
+                candidates = []
+                for url, product in unique_products.items():
                     # Create product entry
                     product_data = {
                         'country': product.get('name', 'Unknown'),
@@ -149,6 +509,14 @@ class BitrefillESimScraper:
                         'plans': []
                     }
                     
+                    if product.get('plans'):
+                        # The card lists its plans inline, so skip its product page
+                        product_data['plans'] = product['plans']
+                        if product.get('countries'):
+                            product_data['countries_covered'] = product['countries']
+                        candidates.append((url, product_data, False))
+                        continue
+                    
                     # Add plan if we have data
                     if product.get('data') or product.get('price'):
                         product_data['plans'].append({
@@ -158,24 +526,41 @@ class BitrefillESimScraper:
                             'price': product.get('price')
                         })
                     
-                    # Try to get more details from product page
-                    try:
-                        detailed = await self._scrape_product_details(page, url)
-                        if detailed and detailed.get('plans'):
-                            product_data = detailed
-                    except:
-                        pass
+                    candidates.append((url, product_data, True))
+                
+                # Fetch product pages concurrently for cards without inline plans,
+                # stopping once enough products have been found
+                detail_urls = [url for url, _, needs_details in candidates if needs_details]
+                inline_count = len(candidates) - len(detail_urls)
+                details = await self._get_details(
+                    detail_urls,
+                    use_cache,
+                    self._scrape_details_concurrently,
+                    limit=max(MAX_PRODUCTS - inline_count, 0)
+                )
+                
+                detailed_products = []
+                for url, product_data, needs_details in candidates:
+                    if needs_details and url not in details:
+                        continue  # Cancelled once enough products were found
+                    
+                    detailed = details.get(url)
+                    if detailed and detailed.get('plans'):
+                        product_data = detailed
                     
                     if product_data.get('plans') or product_data.get('country') != 'Unknown':
                         detailed_products.append(product_data)
                 
                 if detailed_products:
-                    return detailed_products
+                    await self._save_storage_state()
+                    return select_products(detailed_products)
             
             # Fallback to HTML parsing
             content = await page.content()
-            soup = BeautifulSoup(content, 'lxml')
-            return self._extract_from_page_content(soup)
+            products = await self._run_in_thread(self._parse_listing, content)
+            if products:
+                await self._save_storage_state()
+            return products
             
         except Exception as e:
             print(f"Error during scraping: {e}")
@@ -185,13 +570,240 @@ class BitrefillESimScraper:
         finally:
             await page.close()
     
+    async def _scrape_via_http(self, use_cache: bool) -> List[Dict]:
+        """
+        Scrape the server-rendered listing and product pages without a browser.
+        
+        Returns an empty list when the pages don't carry the data inline (for
+        example behind a Cloudflare challenge or when rendered client-side),
+        so the caller falls back to Playwright.
+        """
+        async with httpx.AsyncClient(headers=HTTP_HEADERS, follow_redirects=True, timeout=15) as client:
+            response = await client.get(self.base_url)
+            if response.status_code != 200:
+                return []
+            
+            links = await self._run_in_thread(self._parse_listing_links, response.text)
+            if len(links) < MIN_HTTP_PRODUCT_LINKS:
+                return []
+            
+            details = await self._get_details(
+                [link['url'] for link in links],
+                use_cache,
+                lambda urls, limit: self._fetch_details_via_http(client, urls, limit),
+                limit=MAX_PRODUCTS
+            )
+        
+        # Without any plans the product pages need JavaScript; use the browser
+        if not any(detailed and detailed.get('plans') for detailed in details.values()):
+            return []
+        
+        products = []
+        for link in links:
+            if link['url'] not in details:
+                continue  # Cancelled once enough products were found
+            
+            detailed = details[link['url']]
+            if detailed and detailed.get('plans'):
+                products.append(detailed)
+            else:
+                products.append({
+                    'country': link['name'],
+                    'countries_covered': [link['name']],
+                    'plans': []
+                })
+        return select_products(products)
+    
+    def _parse_listing_links(self, content: str) -> List[Dict]:
+        """Find unique product links in server-rendered listing HTML."""
+        names = {}
+        for link in HTMLParser(content).css('a[href*="/esim-"]'):
+            href = link.attributes.get('href')
+            if not href:
+                continue
+            url = urljoin(self.base_url, href)
+            name = link.text(separator=' ', strip=True) or href.rstrip('/').split('/')[-1].replace('-', ' ')
+            names.setdefault(url, name)
+        return [{'url': url, 'name': name} for url, name in names.items()]
+    
+    async def _fetch_details_via_http(
+        self,
+        client: httpx.AsyncClient,
+        urls: List[str],
+        limit: Optional[int] = None
+    ) -> Dict[str, Optional[Dict]]:
+        """Fetch and parse product pages over HTTP, DETAIL_CONCURRENCY at a time."""
+        async def fetch(url: str) -> Optional[Dict]:
+            try:
+                response = await client.get(url)
+            except httpx.HTTPError as e:
+                print(f"Error fetching product details from {url}: {e}")
+                return None
+            if response.status_code != 200:
+                return None
+            return await self._run_in_thread(self._parse_product_page, response.text, url)
+        
+        # Pages that serve no plans over HTTP (client-rendered pages, challenges)
+        # won't start serving them further down the list, so try one batch first
+        details = await self._gather_details(urls[:DETAIL_CONCURRENCY], fetch, limit)
+        found = sum(1 for detailed in details.values() if detailed and detailed.get('plans'))
+        if not found or (limit is not None and found >= limit):
+            return details
+        
+        remaining = None if limit is None else limit - found
+        details.update(await self._gather_details(urls[DETAIL_CONCURRENCY:], fetch, remaining))
+        return details
+    
+    async def _get_details(
+        self,
+        urls: List[str],
+        use_cache: bool,
+        scrape: Callable[[List[str], Optional[int]], Awaitable[Dict[str, Optional[Dict]]]],
+        limit: Optional[int] = None
+    ) -> Dict[str, Optional[Dict]]:
+        """
+        Get product details by URL, from the disk cache where still fresh and
+        from the given scrape function for the rest.
+        
+        With a limit, scraping stops once that many products have plans; URLs
+        that were never scraped are left out of the result.
+        """
+        details = {}
+        if use_cache:
+            for url in urls:
+                cached = self._load_cached_details(url)
+                if cached:
+                    details[url] = cached
+        
+        remaining = None if limit is None else limit - len(details)
+        # Bound the pages scraped, not just the products found, in case few have plans
+        missing_urls = [url for url in urls if url not in details][:MAX_PRODUCTS]
+        if not missing_urls or (remaining is not None and remaining <= 0):
+            return details
+        
+        for url, detailed in (await scrape(missing_urls, remaining)).items():
+            details[url] = detailed
+            if detailed and detailed.get('plans'):
+                self._save_cached_details(url, detailed)
+        return details
+    
+    async def _gather_details(
+        self,
+        urls: List[str],
+        scrape_one: Callable[[str], Awaitable[Optional[Dict]]],
+        limit: Optional[int] = None
+    ) -> Dict[str, Optional[Dict]]:
+        """
+        Run scrape_one over the URLs, DETAIL_CONCURRENCY at a time, and collect
+        results by URL.
+        
+        Once limit results have plans, no more URLs are started and the ones in
+        flight are cancelled so a few slow pages can't hold up the whole scrape.
+        Failed scrapes map to None.
+        """
+        queued = iter(urls)
+        tasks = {}
+        pending = set()
+        results = {}
+        found = 0
+        
+        try:
+            while limit is None or found < limit:
+                for url in queued:
+                    task = asyncio.ensure_future(scrape_one(url))
+                    tasks[task] = url
+                    pending.add(task)
+                    if len(pending) >= DETAIL_CONCURRENCY:
+                        break
+                if not pending:
+                    break
+                
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    error = task.exception()
+                    if error:
+                        # Expected failures are handled by scrape_one; report the rest
+                        print(f"Unexpected error scraping {tasks[task]}: {error!r}")
+                    result = None if error else task.result()
+                    results[tasks[task]] = result
+                    if result and result.get('plans'):
+                        found += 1
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        
+        return results
+    
+    async def _scrape_details_concurrently(
+        self,
+        urls: List[str],
+        limit: Optional[int] = None
+    ) -> Dict[str, Optional[Dict]]:
+        """
+        Scrape product pages concurrently with a pool of DETAIL_CONCURRENCY pages.
+        
+        Each pooled page lives in its own browser context on the shared browser,
+        seeded with the listing page's cookies so the Cloudflare clearance carries
+        over, and is reused for many URLs instead of being created per URL.
+        """
+        if not urls:
+            return {}
+        
+        storage_state = await self.context.storage_state()
+        pool_size = min(DETAIL_CONCURRENCY, len(urls))
+        contexts = await asyncio.gather(
+            *(self._new_context(storage_state=storage_state) for _ in range(pool_size))
+        )
+        
+        try:
+            page_pool = asyncio.Queue()
+            for page in await asyncio.gather(*(context.new_page() for context in contexts)):
+                page_pool.put_nowait(page)
+            
+            async def scrape(url: str) -> Optional[Dict]:
+                page = await page_pool.get()
+                try:
+                    return await self._scrape_product_details(page, url)
+                finally:
+                    page_pool.put_nowait(page)
+            
+            return await self._gather_details(urls, scrape, limit)
+        finally:
+            for context in contexts:
+                await context.close()
+    
     async def _scrape_product_details(self, page: Page, url: str) -> Optional[Dict]:
         """Scrape details from a specific product page."""
         try:
-            await page.goto(url, wait_until="networkidle", timeout=30000)
-            await asyncio.sleep(3)
+            # Wait for the document to finish parsing so plans further down (and
+            # __NEXT_DATA__, at the end of the body) are there before extracting.
+            # Images, styles and trackers are blocked, so this comes early.
+            try:
+                await page.goto(url, wait_until="domcontentloaded", timeout=15000)
+            except PlaywrightTimeoutError:
+                pass
+            
+            # Client-rendered plans may still appear after the document is parsed
+            try:
+                await page.wait_for_selector('h1, [class*="plan"]', timeout=10000)
+            except PlaywrightTimeoutError:
+                pass
             
-            # Try JavaScript extraction first
+            # Prefer the embedded Next.js page data, scanning the DOM only when
+            # it is missing or has no plans we recognize
+            next_data = await page.evaluate("""
+                () => {
+                    const nextData = document.getElementById('__NEXT_DATA__');
+                    return nextData ? nextData.textContent : null;
+                }
+            """)
+            if next_data:
+                product = await self._run_in_thread(self._product_from_next_data, next_data, url)
+                if product:
+                    return product
+            
+            # Try JavaScript extraction next
             product_data_js = await page.evaluate("""
                 () => {
                     const data = {
@@ -206,18 +818,24 @@ class BitrefillESimScraper:
                         data.name = nameElem.innerText.trim();
                     }
                     
-                    // Extract countries covered
-                    const countryText = document.body.innerText;
-                    const countryMatch = countryText.match(/works?\\s+in[\\s:]+([^\\n]+)/i);
+                    // Extract countries covered, reading the whole page's text
+                    // only when there is no dedicated "works in" section
+                    const worksInPattern = /works?\\s+in[\\s:]+([^\\n]+)/i;
+                    const worksIn = document.querySelector('[data-testid*="works"], [class*="works-in"], [class*="WorksIn"]');
+                    const countryMatch = (worksIn && worksIn.innerText.match(worksInPattern)) ||
+                        document.body.innerText.match(worksInPattern);
                     if (countryMatch) {
-                        const countries = countryMatch[1].split(/[,&]/).map(c => c.trim()).filter(c => c);
+                        const countries = [...new Set(countryMatch[1].split(/[,&]/).map(c => c.trim()).filter(c => c))];
                         data.countries = countries;
                     }
                     
-                    // Extract plans
+                    // Extract plans, skipping wrappers that repeat a plan's text
+                    const seenPlans = new Set();
                     const planElements = document.querySelectorAll('[class*="plan"], [class*="option"], [class*="package"], button, [class*="variant"]');
                     planElements.forEach(elem => {
                         const text = elem.innerText;
+                        if (seenPlans.has(text)) return;
+                        seenPlans.add(text);
                         const priceMatch = text.match(/\\$[\\d,]+(?:\\.\\d{2})?/);
                         const dataMatch = text.match(/(\\d+(?:\\.\\d+)?)\\s*(GB|MB)/i);
                         const validityMatch = text.match(/(\\d+)\\s*(days?|day)/i);
@@ -245,82 +863,209 @@ class BitrefillESimScraper:
             
             # Fallback to HTML parsing
             content = await page.content()
-            soup = BeautifulSoup(content, 'lxml')
-            
-            # Extract product name
-            name_elem = soup.find(['h1', 'h2'], class_=re.compile(r'title|name|heading', re.I))
-            product_name = name_elem.get_text(strip=True) if name_elem else url.split('/')[-1].replace('-', ' ').title()
-            
-            # Extract countries covered
-            countries = []
-            country_elem = soup.find(string=re.compile(r'works in|countries|coverage', re.I))
-            if country_elem:
-                parent = country_elem.find_parent()
-                if parent:
-                    country_list = parent.find_all(['li', 'span', 'div'])
-                    countries = [c.get_text(strip=True) for c in country_list if c.get_text(strip=True) and len(c.get_text(strip=True)) < 50]
-            
-            # Extract plans
-            plans = []
-            plan_sections = soup.find_all(['div', 'section', 'button'], class_=re.compile(r'plan|option|package|variant', re.I))
-            
-            for plan_section in plan_sections:
-                plan_text = plan_section.get_text(strip=True)
-                # Parse plan details (e.g., "1GB 7 Days")
-                data_match = re.search(r'(\d+(?:\.\d+)?)\s*(GB|MB)', plan_text, re.I)
-                validity_match = re.search(r'(\d+)\s*(days?|day)', plan_text, re.I)
-                price_match = re.search(r'\$[\d,]+(?:\.\d{2})?', plan_text)
-                
-                if data_match or price_match:
-                    plans.append({
-                        'name': plan_text[:100] if len(plan_text) > 100 else plan_text,
-                        'data': data_match.group(0) if data_match else None,
-                        'validity': validity_match.group(0) if validity_match else None,
-                        'price': price_match.group(0) if price_match else None
-                    })
+            return await self._run_in_thread(self._parse_product_page, content, url)
+        except PlaywrightError as e:
+            print(f"Error scraping product details from {url}: {e}")
+        return None
+    
+    async def _run_in_thread(self, func, *args):
+        """Run sync parsing and extraction in a worker thread, off the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+    
+    def _parse_listing(self, content: str) -> List[Dict]:
+        """Parse the listing page HTML and extract products from it."""
+        if self.use_selectolax:
+            tree = HTMLParser(content)
+            # BeautifulSoup's get_text() skips these; selectolax's text() doesn't
+            tree.strip_tags(['script', 'style', 'template'])
+            return self._extract_listing_products(
+                self._selectolax_sections(tree),
+                lambda node, strip: node.text(separator='', strip=strip)
+            )
+        return self._extract_listing_products(
+            self._bs4_sections(BeautifulSoup(content, 'lxml')),
+            lambda elem, strip: elem.get_text(strip=strip)
+        )
+    
+    def _parse_product_page(self, content: Union[str, bytes], url: str) -> Optional[Dict]:
+        """Parse a product page's HTML with selectolax and extract its data."""
+        if not content.strip():
+            return None
+        return self._extract_from_product_page(HTMLParser(content), url)
+    
+    def _extract_from_product_page(self, tree: HTMLParser, url: str) -> Optional[Dict]:
+        """
+        Extract eSIM data from a product page parsed by selectolax.
+        
+        Nodes are filtered in Python rather than with selector unions, which
+        selectolax returns grouped by selector instead of in document order.
+        """
+        # Prefer the page's embedded Next.js data over scraping the markup
+        next_data = tree.css_first('script#__NEXT_DATA__')
+        if next_data is not None:
+            product = self._product_from_next_data(next_data.text(), url)
+            if product:
+                return product
+        
+        # Page text never includes script or style contents
+        tree.strip_tags(['script', 'style', 'template'])
+        if tree.root is None:
+            return None
+        nodes = tree.root.css('*')
+        
+        # Extract product name
+        name_elem = next(
+            (node for node in nodes
+             if node.tag in ('h1', 'h2') and TITLE_CLASS_RE.search(node.attributes.get('class') or '')),
+            None
+        )
+        if name_elem is not None:
+            product_name = node_text(name_elem)
+        else:
+            product_name = url.split('/')[-1].replace('-', ' ').title()
+        
+        # Extract countries covered, from a dedicated section if the page has one
+        countries = []
+        parent = next((node for node in nodes if is_coverage_section(node)), None)
+        if parent is None:
+            country_text = next(
+                (node for node in tree.root.traverse(include_text=True)
+                 if node.tag == '-text' and COVERAGE_TEXT_RE.search(node.text_content or '')),
+                None
+            )
+            if country_text is not None:
+                parent = country_text.parent
+        if parent is not None:
+            country_list = (
+                node for node in parent.css('*')
+                if node.tag in ('li', 'span', 'div') and node.mem_id != parent.mem_id
+            )
+            country_names = (node_text(node) for node in country_list)
+            # Nested elements repeat their children's text, so keep each
+            # country once, in page order
+            countries = list(dict.fromkeys(name for name in country_names if name and len(name) < 50))
+        
+        # Extract plans, keyed by text since a plan element and its wrapper
+        # often both match and would otherwise be listed twice
+        plans = {}
+        plan_sections = [
+            node for node in nodes
+            if node.tag in ('div', 'section', 'button') and PLAN_CLASS_RE.search(node.attributes.get('class') or '')
+        ]
+        
+        for plan_section in plan_sections:
+            plan_text = node_text(plan_section)
+            # Parse plan details (e.g., "1GB 7 Days")
+            if plan_text in plans:
+                continue
+            details = parse_plan_text(plan_text)
             
-            if plans or countries or product_name:
-                return {
-                    'country': product_name,
-                    'countries_covered': countries if countries else [product_name],
-                    'plans': plans
+            if details['data'] or details['price']:
+                plans[plan_text] = {
+                    'name': plan_text[:100] if len(plan_text) > 100 else plan_text,
+                    'data': details['data'],
+                    'validity': details['validity'],
+                    'price': details['price']
                 }
-        except Exception as e:
-            print(f"Error scraping product details from {url}: {e}")
+        
+        if plans or countries or product_name:
+            return {
+                'country': product_name,
+                'countries_covered': countries if countries else [product_name],
+                'plans': list(plans.values())
+            }
         return None
     
-    def _extract_from_page_content(self, soup: BeautifulSoup) -> List[Dict]:
-        """Extract eSIM data directly from the main page content."""
-        products = []
+    def _product_from_next_data(self, raw: str, url: str) -> Optional[Dict]:
+        """Build a product from a page's __NEXT_DATA__ JSON, if it lists plans."""
+        try:
+            product = find_next_data_product(json.loads(raw))
+        except ValueError:
+            return None
+        if not product or not product['plans']:
+            return None
+        
+        name = product['name'] or url.split('/')[-1].replace('-', ' ').title()
+        return {
+            'country': name,
+            'countries_covered': product['countries'] or [name],
+            'plans': product['plans']
+        }
+    
+    def _bs4_sections(self, soup: BeautifulSoup) -> Iterator[Tuple[Tag, List[Tuple[str, str, Tag]]]]:
+        """Yield BeautifulSoup product sections with their (tag, class, element) descendants."""
+        for section in soup.find_all(['div', 'article', 'section'], class_=is_product_class):
+            descendants = [
+                (elem.name, ' '.join(elem.get('class', [])), elem)
+                for elem in section.descendants if isinstance(elem, Tag)
+            ]
+            yield section, descendants
+    
+    def _selectolax_sections(self, tree: HTMLParser) -> Iterator[Tuple[Node, List[Tuple[str, str, Node]]]]:
+        """
+        Yield selectolax product sections with their (tag, class, node) descendants.
+        
+        Nodes are filtered in Python rather than with selector unions, which
+        selectolax returns grouped by selector instead of in document order.
+        """
+        for section in tree.css('[class]'):
+            if section.tag not in ('div', 'article', 'section'):
+                continue
+            if not is_product_class(section.attributes.get('class')):
+                continue
+            # Compare by mem_id: Node equality compares serialized HTML
+            descendants = [
+                (node.tag, node.attributes.get('class') or '', node)
+                for node in section.css('*') if node.mem_id != section.mem_id
+            ]
+            yield section, descendants
+    
+    def _extract_listing_products(self, sections, text: Callable[..., str]) -> List[Dict]:
+        """
+        Extract eSIM data from the listing's product sections.
         
-        # Look for product cards or sections
-        product_sections = soup.find_all(['div', 'article', 'section'], 
-                                        class_=re.compile(r'product|card|item|esim', re.I))
+        Shared by both listing parsers: sections come from _bs4_sections or
+        _selectolax_sections, and text(element, strip) returns an element's text.
+        """
+        products = []
         
-        for section in product_sections:
-            # Extract product name
-            name_elem = section.find(['h2', 'h3', 'h4', 'a'], class_=re.compile(r'title|name|heading', re.I))
-            if not name_elem:
-                name_elem = section.find(['h2', 'h3', 'h4', 'a'])
+        for section, descendants in sections:
+            # Extract product name, preferring a heading or link with a title-like class
+            headings = [(cls, elem) for tag, cls, elem in descendants if tag in ('h2', 'h3', 'h4', 'a')]
+            name_elem = next((elem for cls, elem in headings if TITLE_CLASS_RE.search(cls)), None)
+            if name_elem is None and headings:
+                name_elem = headings[0][1]
             
-            if name_elem:
-                product_name = name_elem.get_text(strip=True)
+            if name_elem is not None:
+                product_name = text(name_elem, True)
                 
                 # Extract price
-                price_elem = section.find(['span', 'div'], class_=re.compile(r'price|cost|amount', re.I))
-                price = price_elem.get_text(strip=True) if price_elem else None
+                price_elem = next(
+                    (elem for tag, cls, elem in descendants
+                     if tag in ('span', 'div') and PRICE_CLASS_RE.search(cls)),
+                    None
+                )
+                price = text(price_elem, True) if price_elem is not None else None
                 
-                # Extract plan information
-                plan_text = section.get_text()
-                data_match = re.search(r'(\d+(?:\.\d+)?)\s*(GB|MB)', plan_text, re.I)
-                validity_match = re.search(r'(\d+)\s*(days?|day)', plan_text, re.I)
+                # Extract plan information from the first dedicated data/plan
+                # element that gives both data and validity, otherwise from the
+                # section's text, so both fields always come from one element
+                details = next(
+                    (details for details in (
+                        parse_plan_text(text(elem, False))
+                        for tag, cls, elem in descendants if PLAN_INFO_CLASS_RE.search(cls)
+                    ) if details['data'] and details['validity']),
+                    None
+                ) or parse_plan_text(text(section, False))
+                data, validity = details['data'], details['validity']
                 
                 plans = []
-                if data_match or validity_match:
+                if data or validity:
                     plans.append({
-                        'name': f"{data_match.group(0) if data_match else ''} {validity_match.group(0) if validity_match else ''}".strip(),
-                        'data': data_match.group(0) if data_match else None,
-                        'validity': validity_match.group(0) if validity_match else None,
+                        'name': f"{data or ''} {validity or ''}".strip(),
+                        'data': data,
+                        'validity': validity,
                         'price': price
                     })
                 
@@ -333,7 +1078,6 @@ class BitrefillESimScraper:
         
         return products
 
-
 async def main():
     """Test the scraper."""
     scraper = BitrefillESimScraper()
@@ -345,6 +1089,7 @@ async def main():
             print(f"\n{product}")
     finally:
         await scraper.close_browser()
+        await close_shared_browser()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,147 @@
+"""
+Tests for the scraper's offline parsing helpers.
+Run with: python -m pytest
+"""
+from scraper import MAX_PRODUCTS, BitrefillESimScraper, find_next_data_product, format_price, select_products
+
+
+def test_format_price_accepts_numbers_and_numeric_strings():
+    assert format_price(4.5) == "$4.50"
+    assert format_price(12) == "$12.00"
+    assert format_price("1,200") == "$1,200.00"
+    assert format_price("$9.99") == "$9.99"
+
+
+def test_format_price_rejects_other_types():
+    assert format_price(True) is None
+    assert format_price({'amount': {'value': 5}}) is None
+    assert format_price(["5"]) is None
+    assert format_price(None) is None
+    assert format_price("free") is None
+    assert format_price(float('nan')) is None
+
+
+def test_next_data_product_is_normalized():
+    data = {'props': {'pageProps': {'product': {
+        'name': 'Europe eSIM',
+        'countries': [{'name': 'France'}, 'Spain', 'France'],
+        'packages': [{'name': '1GB, 7 Days', 'usd_price': 4.5}],
+    }}}}
+    assert find_next_data_product(data) == {
+        'name': 'Europe eSIM',
+        'countries': ['France', 'Spain'],
+        'plans': [{'name': '1GB, 7 Days', 'data': '1GB', 'validity': '7 Days', 'price': '$4.50'}],
+    }
+
+
+def test_next_data_skips_plans_with_bad_types():
+    data = {'product': {
+        'name': {'en': 'Japan'},
+        'countries': 'US',
+        'plans': [
+            {'name': {'en': '1GB'}, 'price': 3},
+            {'name': '3GB 30 days', 'price': True},
+            {'name': '5GB 30 days', 'price': {'amount': {'value': 5}}},
+            {'name': '10GB 30 days', 'price': '12.5'},
+        ],
+    }}
+    product = find_next_data_product(data)
+    assert product['name'] is None
+    assert product['countries'] == []
+    assert [plan['name'] for plan in product['plans']] == ['10GB 30 days']
+    assert product['plans'][0]['price'] == '$12.50'
+
+
+def test_next_data_without_valid_plans_is_ignored():
+    data = {'product': {'name': 'Japan', 'plans': [{'name': 'Sold out', 'price': None}]}}
+    assert find_next_data_product(data) is None
+
+
+def test_next_data_ignores_generic_option_lists():
+    data = {
+        'filters': {'options': [{'name': 'Sort', 'amount': 3}]},
+        'product': {'name': 'Japan'},
+    }
+    assert find_next_data_product(data) is None
+
+
+LISTING_HTML = """
+<html><body>
+<div class="listing-grid">
+  <div class="card">
+    <h3 class="title">Japan</h3>
+    <span class="price">$4.50</span>
+    <div class="plan">1GB 7 days</div>
+  </div>
+  <article class="esim-item">
+    <h2>France</h2>
+    <span class="price">$9.00</span>
+    <span class="data">5GB</span><span class="validity">30 Days</span>
+  </article>
+  <div class="card-promo">
+    <h4>Deals</h4>
+    <script>window.promo = {"title": "USAe", "data": "99GB"};</script>
+    <style>.card-promo h4::after { content: "99GB"; }</style>
+  </div>
+</div>
+</body></html>
+"""
+
+
+def test_listing_parsers_agree():
+    selectolax_products = BitrefillESimScraper(use_selectolax=True)._parse_listing(LISTING_HTML)
+    bs4_products = BitrefillESimScraper(use_selectolax=False)._parse_listing(LISTING_HTML)
+    assert selectolax_products == bs4_products
+    assert [product['country'] for product in selectolax_products] == ['Japan', 'France']
+
+
+def test_listing_ignores_script_and_style_text():
+    products = BitrefillESimScraper(use_selectolax=True)._parse_listing(LISTING_HTML)
+    assert all('99GB' not in plan['name'] for product in products for plan in product['plans'])
+
+
+def test_listing_plan_fields_come_from_one_element():
+    html = """
+    <div class="card">
+      <h3 class="title">Italy</h3>
+      <span class="price">$6.00</span>
+      <span class="metadata">20GB bonus</span>
+      <div class="plan">3GB 15 days</div>
+    </div>
+    """
+    for use_selectolax in (True, False):
+        products = BitrefillESimScraper(use_selectolax=use_selectolax)._parse_listing(html)
+        assert products[0]['plans'][0]['name'] == '3GB 15 days'
+
+
+def test_listing_plan_fields_fall_back_to_section_text():
+    for use_selectolax in (True, False):
+        products = BitrefillESimScraper(use_selectolax=use_selectolax)._parse_listing(LISTING_HTML)
+        france = next(product for product in products if product['country'] == 'France')
+        assert france['plans'][0]['data'] == '5GB'
+        assert france['plans'][0]['validity'] == '30 Days'
+
+
+def test_product_page_with_xml_declaration_is_parsed():
+    html = (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<html><body><h1 class="title">Japan</h1><div class="plan">1GB 7 days $3.00</div></body></html>'
+    )
+    product = BitrefillESimScraper()._parse_product_page(html, 'https://www.bitrefill.com/us/en/esims/esim-japan/')
+    assert product['country'] == 'Japan'
+    assert product['plans'] == [{'name': '1GB 7 days $3.00', 'data': '1GB', 'validity': '7 days', 'price': '$3.00'}]
+
+
+def test_product_page_countries_skip_the_coverage_element_itself():
+    html = '<html><body><h1 class="title">EU</h1><div>Works in<ul><li><span>France</span></li><li>Spain</li></ul></div></body></html>'
+    product = BitrefillESimScraper()._parse_product_page(html, 'https://www.bitrefill.com/us/en/esims/esim-eu/')
+    assert product['countries_covered'] == ['France', 'Spain']
+
+
+def test_select_products_prefers_products_with_plans():
+    stubs = [{'country': f'Stub {i}', 'plans': []} for i in range(MAX_PRODUCTS)]
+    priced = {'country': 'Japan', 'plans': [{'name': '1GB 7 days', 'price': '$3.00'}]}
+    selected = select_products(stubs + [priced])
+    assert len(selected) == MAX_PRODUCTS
+    assert selected[-1] is priced
+    assert selected[:-1] == stubs[:-1]